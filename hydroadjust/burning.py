@@ -1,16 +1,14 @@
-from osgeo import gdal
+from osgeo import gdal, gdal_array, ogr, osr
+import numpy as np
 
-def burn_lines(raster, lines):
-    """
-    Burn elevation of vector line segments into raster, modifying the raster
-    dataset in-place.
+from concurrent.futures import ThreadPoolExecutor
 
-    :param raster: DEM raster to burn lines into
-    :type raster: GDAL Dataset object
-    :param lines: line segments whose elevation should be burned in
-    :type lines: OGR Layer object
-    """
 
+# Geotransform under which georeferenced and pixel coordinates coincide
+IDENTITY_GEOTRANSFORM = [0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
+
+
+def _rasterize_lines(raster, lines):
     # The "burn value" must be set to 0, resulting in 0 + the z value being
     # burned in. The default is 255 + z (yes, really).
     # See https://lists.osgeo.org/pipermail/gdal-dev/2015-August/042360.html
@@ -24,3 +22,203 @@ def burn_lines(raster, lines):
             'ALL_TOUCHED=TRUE', # ensure connectedness of resulting pixels
         ],
     )
+
+
+def _transform_xy(geometry, transform):
+    # Apply a function to the X and Y of all points of a (possibly
+    # multi-part) geometry in-place, leaving Z unchanged
+    for i in range(geometry.GetGeometryCount()):
+        _transform_xy(geometry.GetGeometryRef(i), transform)
+
+    if geometry.GetPointCount() == 0:
+        return
+
+    points = np.array(geometry.GetPoints())
+    x, y = transform(points[:,0], points[:,1])
+    for i in range(points.shape[0]):
+        if points.shape[1] >= 3:
+            geometry.SetPoint(i, x[i], y[i], points[i,2])
+        else:
+            geometry.SetPoint_2D(i, x[i], y[i])
+
+
+def _burn_row_band(z_grid, row_min, row_max, geometries):
+    # Wrap the rows of the shared buffer belonging to this band in a dataset
+    # of their own (without copying). The geometries are already in the
+    # band's pixel coordinates.
+    band_dataset = gdal_array.OpenArray(z_grid[row_min:row_max])
+    band_dataset.SetGeoTransform(IDENTITY_GEOTRANSFORM)
+
+    # Each band gets its own vector layer, as OGR layers must not be shared
+    # between threads. Feature order is preserved, so that overlapping lines
+    # are burned in the same order as in the serial case.
+    band_datasrc = ogr.GetDriverByName("MEMORY").CreateDataSource("temp_band_lines")
+    band_layer = band_datasrc.CreateLayer(
+        "lines",
+        geom_type=ogr.wkbLineString25D,
+    )
+    for geometry in geometries:
+        feature = ogr.Feature(band_layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        band_layer.CreateFeature(feature)
+        feature = None
+
+    _rasterize_lines(band_dataset, band_layer)
+
+    band_dataset.FlushCache()
+    band_dataset = None
+
+
+def _check_threading_arguments(num_threads, rows_per_band):
+    if num_threads < 1:
+        raise ValueError(f"number of threads must be at least 1, got {num_threads}")
+    if rows_per_band is not None and rows_per_band < 1:
+        raise ValueError(f"rows per band must be at least 1, got {rows_per_band}")
+
+
+def burn_lines_into_array(z_grid, geotransform, projection, lines, num_threads, rows_per_band=None):
+    """
+    Burn elevation of vector line segments into a NumPy array of raster
+    values, modifying the array in-place.
+
+    The array is split into horizontal bands of rows, which are burned
+    concurrently using only the lines intersecting each band. The result is
+    the same as burning the whole raster with burn_lines() on a single
+    thread.
+
+    :param z_grid: raster values to burn lines into
+    :type z_grid: 2D NumPy array
+    :param geotransform: geotransform of the raster
+    :type geotransform: sequence of 6 floats
+    :param projection: projection of the raster, as returned by
+        GetProjection(). Lines in a different spatial reference system are
+        reprojected to it, as RasterizeLayer does
+    :type projection: str
+    :param lines: line segments whose elevation should be burned in
+    :type lines: OGR Layer object
+    :param num_threads: number of threads to burn with
+    :type num_threads: int
+    :param rows_per_band: number of raster rows per band. Defaults to
+        splitting the raster evenly between the threads
+    :type rows_per_band: int or None
+    """
+
+    _check_threading_arguments(num_threads, rows_per_band)
+
+    if geotransform[2] != 0.0 or geotransform[4] != 0.0:
+        raise ValueError("geotransforms with rotation are unsupported")
+
+    num_rows = z_grid.shape[0]
+
+    if rows_per_band is None:
+        rows_per_band = max(1, int(np.ceil(num_rows / num_threads)))
+
+    row_bounds = [
+        (row_min, min(row_min + rows_per_band, num_rows))
+        for row_min in range(0, num_rows, rows_per_band)
+    ]
+
+    # Reproject the lines if their SRS differs from the raster's, following
+    # the same rule as RasterizeLayer in the serial case
+    coordinate_transformation = None
+    lines_srs = lines.GetSpatialRef()
+    if lines_srs is not None and projection:
+        raster_srs = osr.SpatialReference()
+        raster_srs.ImportFromWkt(projection)
+        if not lines_srs.IsSame(raster_srs):
+            source_srs = lines_srs.Clone()
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            coordinate_transformation = osr.CoordinateTransformation(source_srs, raster_srs)
+
+    # Convert the lines to pixel coordinates of the full raster, in the same
+    # way as GDAL does when rasterizing the full raster. Shifting them to the
+    # bands by whole rows is then exact, just like GDAL's own chunking of
+    # large rasters, so the same pixels are touched.
+    inv_geotransform = gdal.InvGeoTransform(geotransform)
+
+    def geo_to_pixel(x, y):
+        col = inv_geotransform[0] + x*inv_geotransform[1] + y*inv_geotransform[2]
+        row = inv_geotransform[3] + x*inv_geotransform[4] + y*inv_geotransform[5]
+        return col, row
+
+    pixel_geometries = []
+    lines.ResetReading()
+    for feature in lines:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+
+        pixel_geometry = geometry.Clone()
+        if coordinate_transformation is not None:
+            pixel_geometry.Transform(coordinate_transformation)
+        _transform_xy(pixel_geometry, geo_to_pixel)
+        pixel_geometries.append(pixel_geometry)
+    lines.ResetReading()
+
+    # Distribute the line geometries between the bands they intersect,
+    # finding the range of bands directly from the rows they cover. The rows
+    # are padded by one here to stay clear of trouble at the band edges;
+    # lines that are included without touching a band are harmless.
+    band_geometries = [[] for _ in row_bounds]
+    for pixel_geometry in pixel_geometries:
+        _, _, geometry_row_min, geometry_row_max = pixel_geometry.GetEnvelope()
+        first_band = max(0, int(np.floor((geometry_row_min - 1) / rows_per_band)))
+        last_band = min(len(row_bounds) - 1, int(np.floor((geometry_row_max + 1) / rows_per_band)))
+
+        for band_number in range(first_band, last_band + 1):
+            row_min = row_bounds[band_number][0]
+            band_geometry = pixel_geometry.Clone()
+            _transform_xy(band_geometry, lambda col, row: (col, row - row_min))
+            band_geometries[band_number].append(band_geometry)
+
+    # GDAL releases the GIL while rasterizing, so the bands are burned in
+    # parallel. Bands cover disjoint rows of the buffer.
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [
+            executor.submit(_burn_row_band, z_grid, row_min, row_max, geometries)
+            for (row_min, row_max), geometries in zip(row_bounds, band_geometries)
+            if geometries
+        ]
+        for future in futures:
+            future.result()
+
+
+def burn_lines(raster, lines, num_threads=1, rows_per_band=None):
+    """
+    Burn elevation of vector line segments into raster, modifying the raster
+    dataset in-place.
+
+    With more than one thread, band 1 of the raster is read into memory and
+    burned with burn_lines_into_array(). When burning several layers into a
+    large raster, calling that directly avoids reading and writing the
+    raster for each layer.
+
+    :param raster: DEM raster to burn lines into
+    :type raster: GDAL Dataset object
+    :param lines: line segments whose elevation should be burned in
+    :type lines: OGR Layer object
+    :param num_threads: number of threads to burn with
+    :type num_threads: int
+    :param rows_per_band: number of raster rows per band. Defaults to
+        splitting the raster evenly between the threads
+    :type rows_per_band: int or None
+    """
+
+    _check_threading_arguments(num_threads, rows_per_band)
+
+    if num_threads == 1:
+        _rasterize_lines(raster, lines)
+        return
+
+    raster_band = raster.GetRasterBand(1)
+    z_grid = raster_band.ReadAsArray()
+    burn_lines_into_array(
+        z_grid,
+        raster.GetGeoTransform(),
+        raster.GetProjection(),
+        lines,
+        num_threads,
+        rows_per_band=rows_per_band,
+    )
+    raster_band.WriteArray(z_grid)
@@ -0,0 +1,441 @@
+from osgeo import gdal
+import numpy as np
+
+from collections import defaultdict, namedtuple
+import hashlib
+import io
+import os
+import sqlite3
+import time
+
+
+# Bookkeeping for one source file of the DEM raster: its georeferenced extent
+# and a checksum of its contents.
+TileFingerprint = namedtuple(
+    'TileFingerprint',
+    ['path', 'checksum', 'x_min', 'x_max', 'y_min', 'y_max'],
+)
+
+# Bump when the meaning of keys or stored values changes, to invalidate
+# entries written by earlier versions
+CACHE_FORMAT_VERSION = 1
+
+# Seconds to wait for another process holding the write lock of the cache
+CONNECT_TIMEOUT = 600.0
+
+# Number of writes after which pending changes are committed, releasing the
+# write lock for other processes sharing the cache
+COMMIT_INTERVAL = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    key TEXT PRIMARY KEY,
+    z BLOB NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    x_min REAL NOT NULL,
+    x_max REAL NOT NULL,
+    y_min REAL NOT NULL,
+    y_max REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS non_rasters (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+def _connect(path):
+    # WAL mode lets readers proceed while another process writes
+    connection = sqlite3.connect(path, timeout=CONNECT_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def get_file_stat(path):
+    """
+    Return size and modification time of a file, or None if it does not
+    exist. Paths in GDAL's virtual filesystems (/vsicurl/, /vsizip/ etc.) are
+    supported, though their modification time is only known to the second.
+
+    :param path: Path to file
+    :type path: str
+    :returns: Tuple of (size in bytes, modification time in nanoseconds)
+    """
+
+    if path.startswith('/vsi'):
+        stat_result = gdal.VSIStatL(path)
+        if stat_result is None:
+            return None
+        return stat_result.size, stat_result.mtime*1000000000
+
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+
+def get_file_checksum(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of a file's contents. Paths in GDAL's
+    virtual filesystems are supported.
+
+    :param path: Path to file
+    :type path: str
+    :param chunk_size: Number of bytes to read at a time
+    :type chunk_size: int
+    :returns: Hex digest string
+    """
+
+    file_handle = gdal.VSIFOpenL(path, 'rb')
+    if file_handle is None:
+        raise FileNotFoundError(f"unable to open {path} for checksumming")
+
+    file_hash = hashlib.sha256()
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, chunk_size, file_handle)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    finally:
+        gdal.VSIFCloseL(file_handle)
+
+    return file_hash.hexdigest()
+
+
+class SamplingCache:
+    """
+    Persistent SQLite cache of Z values sampled from a DEM raster.
+
+    Entries are keyed on the 2D vertices of the object, the checksums of the
+    DEM source files whose extent touches the object, the geotransform,
+    NODATA value, scale and offset of the DEM and the profile sampling
+    distance (if any). An object whose geometry and underlying DEM tiles are
+    unchanged since a previous run can then have its Z values copied through
+    without reading the raster.
+
+    Several processes may share a cache file. Changes are committed
+    periodically, so that they only hold the write lock briefly.
+
+    :param path: Path to SQLite database file, created if missing
+    :type path: str
+    :param dataset: DEM raster dataset that samples are taken from
+    :type dataset: GDAL Dataset object
+    :param max_profile_sample_dist: Profile sampling distance used, if any
+    :type max_profile_sample_dist: float or None
+    """
+
+    def __init__(self, path, dataset, max_profile_sample_dist=None):
+        self.connection = _connect(path)
+
+        try:
+            self._setup(dataset, max_profile_sample_dist)
+        except Exception:
+            self.connection.close()
+            raise
+
+        self.now = time.time()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.pending_write_count = 0
+
+    def _setup(self, dataset, max_profile_sample_dist):
+        geotransform = dataset.GetGeoTransform()
+        if geotransform[2] != 0.0 or geotransform[4] != 0.0:
+            raise ValueError("geotransforms with rotation are unsupported")
+
+        # The window extracted for sampling is padded by one pixel (plus
+        # rounding) on each side, so look for touched tiles within a margin
+        # of two pixels around the object.
+        self.margin_x = 2.0*abs(geotransform[1])
+        self.margin_y = 2.0*abs(geotransform[5])
+
+        # Parameters shared by all entries of this run, as part of the key.
+        # NODATA, scale and offset may be defined in a VRT or sidecar file
+        # rather than in the tiles themselves, so they are included here.
+        band = dataset.GetRasterBand(1)
+        self.context = repr((
+            CACHE_FORMAT_VERSION,
+            tuple(geotransform),
+            band.GetNoDataValue(),
+            band.GetScale(),
+            band.GetOffset(),
+            max_profile_sample_dist,
+        ))
+
+        self.tiles = self._get_tile_fingerprints(dataset)
+        self.connection.commit()
+
+        if len(self.tiles) == 0:
+            raise ValueError("unable to determine source files of DEM raster, cannot cache samples")
+
+        self._build_tile_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_tile_fingerprint(self, path):
+        # Reuse the stored checksum and extent if the file appears unchanged
+        # since it was last fingerprinted, to avoid opening or rehashing the
+        # entire DEM on every run. Returns None for files that are not
+        # rasters.
+        stat_result = get_file_stat(path)
+        if stat_result is None:
+            raise FileNotFoundError(f"DEM source file {path} does not exist")
+        size, mtime_ns = stat_result
+
+        row = self.connection.execute(
+            "SELECT checksum, x_min, x_max, y_min, y_max FROM tiles "
+            "WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, size, mtime_ns),
+        ).fetchone()
+
+        if row is not None:
+            return TileFingerprint(path, *row)
+
+        row = self.connection.execute(
+            "SELECT 1 FROM non_rasters "
+            "WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, size, mtime_ns),
+        ).fetchone()
+
+        if row is not None:
+            return None
+
+        # Sidecar files (.aux.xml etc.) are not rasters. Anything in them
+        # that affects sampled values is part of the key through the
+        # dataset's NODATA value, scale and offset.
+        if gdal.IdentifyDriver(path) is None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO non_rasters VALUES (?, ?, ?)",
+                (path, size, mtime_ns),
+            )
+            return None
+
+        tile_dataset = gdal.Open(path)
+        geotransform = tile_dataset.GetGeoTransform()
+        x_edges = (
+            geotransform[0],
+            geotransform[0] + geotransform[1]*tile_dataset.RasterXSize,
+        )
+        y_edges = (
+            geotransform[3],
+            geotransform[3] + geotransform[5]*tile_dataset.RasterYSize,
+        )
+        tile_dataset = None
+
+        fingerprint = TileFingerprint(
+            path=path,
+            checksum=get_file_checksum(path),
+            x_min=min(x_edges),
+            x_max=max(x_edges),
+            y_min=min(y_edges),
+            y_max=max(y_edges),
+        )
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                size,
+                mtime_ns,
+                *fingerprint[1:],
+            ),
+        )
+
+        return fingerprint
+
+    def _get_tile_fingerprints(self, dataset):
+        file_list = dataset.GetFileList() or []
+        main_path = dataset.GetDescription()
+        is_vrt = dataset.GetDriver().ShortName == "VRT"
+
+        fingerprints = []
+        for path in file_list:
+            # For a VRT, the tiles are what matters; the VRT file itself is
+            # typically regenerated every run and would invalidate everything.
+            if is_vrt and path == main_path:
+                continue
+
+            fingerprint = self._get_tile_fingerprint(path)
+            if fingerprint is not None:
+                fingerprints.append(fingerprint)
+
+        return fingerprints
+
+    def _build_tile_index(self):
+        # Bucket the tiles on a regular grid with cells the size of a typical
+        # tile, so that looking up the tiles touching an object only needs to
+        # consider a handful of candidates rather than the entire DEM.
+        self.cell_size_x = np.median([tile.x_max - tile.x_min for tile in self.tiles]) or 1.0
+        self.cell_size_y = np.median([tile.y_max - tile.y_min for tile in self.tiles]) or 1.0
+
+        self.tile_index = defaultdict(list)
+        for tile_number, tile in enumerate(self.tiles):
+            for cell in self._get_cells(
+                tile.x_min - self.margin_x,
+                tile.x_max + self.margin_x,
+                tile.y_min - self.margin_y,
+                tile.y_max + self.margin_y,
+            ):
+                self.tile_index[cell].append(tile_number)
+
+    def _get_cells(self, x_min, x_max, y_min, y_max):
+        col_min = int(np.floor(x_min / self.cell_size_x))
+        col_max = int(np.floor(x_max / self.cell_size_x))
+        row_min = int(np.floor(y_min / self.cell_size_y))
+        row_max = int(np.floor(y_max / self.cell_size_y))
+
+        return [
+            (col, row)
+            for col in range(col_min, col_max + 1)
+            for row in range(row_min, row_max + 1)
+        ]
+
+    def get_key(self, xy, bbox):
+        """
+        Return the cache key for an object.
+
+        :param xy: X and Y of the object's vertices
+        :type xy: NumPy array of shape (num_vertices, 2)
+        :param bbox: Bounding box of the object
+        :type bbox: hydroadjust.sampling.BoundingBox object
+        :returns: Key string
+        """
+
+        candidate_tile_numbers = set()
+        for cell in self._get_cells(bbox.x_min, bbox.x_max, bbox.y_min, bbox.y_max):
+            candidate_tile_numbers.update(self.tile_index.get(cell, ()))
+
+        touched_checksums = sorted(
+            tile.checksum for tile in (self.tiles[i] for i in candidate_tile_numbers)
+            if tile.x_min <= bbox.x_max + self.margin_x
+            and tile.x_max >= bbox.x_min - self.margin_x
+            and tile.y_min <= bbox.y_max + self.margin_y
+            and tile.y_max >= bbox.y_min - self.margin_y
+        )
+
+        key_hash = hashlib.sha256()
+        key_hash.update(np.ascontiguousarray(xy, dtype='<f8').tobytes())
+        key_hash.update(self.context.encode())
+        for checksum in touched_checksums:
+            key_hash.update(checksum.encode())
+
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        """
+        Look up sampled Z values, returning None if not present.
+
+        :param key: Key as returned by get_key()
+        :type key: str
+        :returns: NumPy array of Z values, or None
+        """
+
+        row = self.connection.execute(
+            "SELECT z FROM samples WHERE key = ?",
+            (key,),
+        ).fetchone()
+
+        if row is None:
+            self.miss_count += 1
+            return None
+
+        # Mark as used in this run, so that compaction keeps it around
+        self.connection.execute(
+            "UPDATE samples SET last_used = ? WHERE key = ?",
+            (self.now, key),
+        )
+        self.hit_count += 1
+        self._count_write()
+
+        return np.load(io.BytesIO(row[0]))
+
+    def put(self, key, z):
+        """
+        Store sampled Z values.
+
+        :param key: Key as returned by get_key()
+        :type key: str
+        :param z: Z values. May contain NaN for missing DEM data
+        :type z: NumPy array
+        """
+
+        z_buffer = io.BytesIO()
+        np.save(z_buffer, np.asarray(z, dtype=np.float64))
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO samples VALUES (?, ?, ?)",
+            (key, z_buffer.getvalue(), self.now),
+        )
+        self._count_write()
+
+    def _count_write(self):
+        self.pending_write_count += 1
+        if self.pending_write_count >= COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending_write_count = 0
+
+    def close(self):
+        """
+        Commit pending changes and close the database.
+        """
+
+        self.connection.commit()
+        self.connection.close()
+
+
+def compact_cache(path, max_age_days):
+    """
+    Evict stale entries from a sampling cache database and reclaim the space.
+
+    :param path: Path to SQLite database file
+    :type path: str
+    :param max_age_days: Evict samples not used within this many days
+    :type max_age_days: float
+    :returns: Tuple of (evicted sample count, evicted tile count)
+    """
+
+    # Connecting would otherwise silently create a new, empty database
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"sampling cache {path} does not exist")
+
+    connection = _connect(path)
+
+    cutoff = time.time() - 86400.0*max_age_days
+    evicted_sample_count = connection.execute(
+        "DELETE FROM samples WHERE last_used < ?",
+        (cutoff,),
+    ).rowcount
+
+    # Forget fingerprints of tiles that no longer exist
+    missing_paths = [
+        (tile_path,) for (tile_path,) in connection.execute("SELECT path FROM tiles")
+        if get_file_stat(tile_path) is None
+    ]
+    connection.executemany("DELETE FROM tiles WHERE path = ?", missing_paths)
+    connection.executemany(
+        "DELETE FROM non_rasters WHERE path = ?",
+        [
+            (file_path,) for (file_path,) in connection.execute("SELECT path FROM non_rasters")
+            if get_file_stat(file_path) is None
+        ],
+    )
+    connection.commit()
+
+    connection.execute("VACUUM")
+    connection.close()
+
+    return evicted_sample_count, len(missing_paths)
@@ -1,4 +1,4 @@
-from hydroadjust.burning import burn_lines
+from hydroadjust.burning import burn_lines, burn_lines_into_array
 
 from osgeo import gdal, ogr
 import argparse
@@ -10,10 +10,14 @@ def main():
     argument_parser.add_argument('lines', type=str, help='linestring features with DEM-sampled Z')
     argument_parser.add_argument('input_raster', type=str, help='DEM input raster')
     argument_parser.add_argument('output_raster', type=str, help='DEM output raster with objects burned in')
+    argument_parser.add_argument('--threads', type=int, default=1, help='number of threads to burn row bands of the raster with')
     argument_parser.add_argument('--log-level', type=str)
 
     input_arguments = argument_parser.parse_args()
 
+    if input_arguments.threads < 1:
+        argument_parser.error("--threads must be at least 1")
+
     lines_path = input_arguments.lines
     input_raster_path = input_arguments.input_raster
     output_raster_path = input_arguments.output_raster
@@ -22,6 +26,31 @@ def main():
 
     lines_datasrc = ogr.Open(lines_path)
 
+    if input_arguments.threads > 1:
+        # Burn all layers into one in-memory array of band 1, read once, and
+        # write it out only when rasterization is complete. This avoids
+        # holding an intermediate copy of the (large) raster besides the array.
+        z_grid = input_raster_dataset.GetRasterBand(1).ReadAsArray()
+        for layer in lines_datasrc:
+            burn_lines_into_array(
+                z_grid,
+                input_raster_dataset.GetGeoTransform(),
+                input_raster_dataset.GetProjection(),
+                layer,
+                input_arguments.threads,
+            )
+            logging.info(f"burned layer {layer.GetName()} into temporary array")
+
+        output_driver = gdal.GetDriverByName("GTiff")
+        output_raster_dataset = output_driver.CreateCopy(
+            output_raster_path,
+            input_raster_dataset,
+        )
+        output_raster_dataset.GetRasterBand(1).WriteArray(z_grid)
+        output_raster_dataset = None
+        logging.info("output raster written")
+        return
+
     # Create an intermediate, in-memory dataset that the lines will be burned
     # into. This is done in order to prevent writing a premature output raster
     # in case something goes wrong during the line rasterization.
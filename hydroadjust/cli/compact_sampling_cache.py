@@ -0,0 +1,26 @@
+from hydroadjust.caching import compact_cache
+
+import argparse
+import logging
+
+# Entry point for use in setup.py
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('cache', type=str, help='SQLite sampling cache file to compact')
+    argument_parser.add_argument('--max-age-days', type=float, default=30.0, help='evict samples not used within this many days')
+    argument_parser.add_argument('--log-level', type=str, default='INFO', help='logging level, e.g. WARNING to suppress the summary')
+
+    input_arguments = argument_parser.parse_args()
+
+    logging.basicConfig(level=input_arguments.log_level.upper())
+
+    evicted_sample_count, evicted_tile_count = compact_cache(
+        input_arguments.cache,
+        input_arguments.max_age_days,
+    )
+
+    logging.info(f"evicted {evicted_sample_count} samples and {evicted_tile_count} missing tiles from cache")
+
+# Allows executing this module with "python -m"
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 from hydroadjust.sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from hydroadjust.caching import SamplingCache
 
 from osgeo import gdal, ogr
 import numpy as np
 from tqdm import tqdm
 import argparse
+from contextlib import nullcontext
 import logging
 
 gdal.UseExceptions()
@@ -23,6 +25,7 @@ def main():
     argument_parser.add_argument('input_horseshoes', type=str, help='input horseshoe vector data source')
     argument_parser.add_argument('output_lines', type=str, help='output linestring geometry file')
     argument_parser.add_argument('--max-sample-dist', type=float, help='maximum allowed sampling distance on profiles')
+    argument_parser.add_argument('--cache', type=str, help='SQLite file to cache sampled Z in between runs')
 
     input_arguments = argument_parser.parse_args()
 
@@ -43,6 +46,16 @@ def main():
     else:
         max_profile_sample_dist = input_arguments.max_sample_dist
 
+    # Samples stored so far are committed even if the loop below fails
+    if input_arguments.cache is None:
+        sampling_cache_context = nullcontext()
+    else:
+        sampling_cache_context = SamplingCache(
+            input_arguments.cache,
+            input_raster_dataset,
+            max_profile_sample_dist=max_profile_sample_dist,
+        )
+
     input_horseshoes_datasrc = ogr.Open(input_horseshoes_path)
     input_horseshoes_layer = input_horseshoes_datasrc.GetLayer()
 
@@ -61,82 +74,101 @@ def main():
     valid_profile_count = 0
     invalid_profile_count = 0
 
-    for horseshoe_feature in tqdm(input_horseshoes_layer, ascii=True, unit="obj"):
-        horseshoe_geometry = horseshoe_feature.GetGeometryRef()
+    with sampling_cache_context as sampling_cache:
+        for horseshoe_feature in tqdm(input_horseshoes_layer, ascii=True, unit="obj"):
+            horseshoe_geometry = horseshoe_feature.GetGeometryRef()
         
-        # Rule out non-horseshoe geometries (apparently calling .GetGeomType() on
-        # the layer yields weird results)
-        if not (horseshoe_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
-            raise ValueError("encountered unexpected geometry type")
+            # Rule out non-horseshoe geometries (apparently calling .GetGeomType() on
+            # the layer yields weird results)
+            if not (horseshoe_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
+                raise ValueError("encountered unexpected geometry type")
         
-        if horseshoe_geometry.GetPointCount() == 4:
-            # We want to consider only the X and Y of the geometry
-            horseshoe_xy = np.array(horseshoe_geometry.GetPoints())[:,:2]
-
-            horseshoe_bbox = BoundingBox(
-                x_min=np.min(horseshoe_xy[:,0]),
-                x_max=np.max(horseshoe_xy[:,0]),
-                y_min=np.min(horseshoe_xy[:,1]),
-                y_max=np.max(horseshoe_xy[:,1]),
-            )
-
-            # Get a raster window just covering this horseshoe
-            window_raster_dataset = get_raster_window(input_raster_dataset, horseshoe_bbox)
-
-            window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-
-            # Length of (open) AD segment
-            open_profile_length = np.hypot(
-                horseshoe_xy[3, 0] - horseshoe_xy[0, 0],
-                horseshoe_xy[3, 1] - horseshoe_xy[0, 1],
-            )
-            # Length of (closed) BC segment
-            closed_profile_length = np.hypot(
-                horseshoe_xy[2, 0] - horseshoe_xy[1, 0],
-                horseshoe_xy[2, 1] - horseshoe_xy[1, 1],
-            )
-
-            # Determine number of samples to take along the profiles (at least 2)
-            longest_profile_length = max(open_profile_length, closed_profile_length)
-            num_profile_samples = max(2, int(np.ceil(longest_profile_length / max_profile_sample_dist)) + 1)
-
-            # Along-profile coordinates
-            profile_abscissa = np.linspace(
-                0.0,
-                1.0,
-                num_profile_samples,
-                endpoint=True,
-            )
-
-            # Interpolate (X, Y) along the two profiles
-            open_profile_xy = horseshoe_xy[0,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[3,:] - horseshoe_xy[0,:])
-            closed_profile_xy = horseshoe_xy[1,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[2,:] - horseshoe_xy[1,:])
-
-            # Sample the raster Z in those interpolated (X, Y) locations
-            open_profile_z = window_raster_interpolator((open_profile_xy[:,0], open_profile_xy[:,1]))
-            closed_profile_z = window_raster_interpolator((closed_profile_xy[:,0], closed_profile_xy[:,1]))
-
-            # Render only if there is no NaN in the profiles
-            if np.all(np.isfinite(open_profile_z)) and np.all(np.isfinite(closed_profile_z)):
-                # Create line features
-                for i in range(num_profile_samples):
-                    line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                    line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                    line_geometry.AddPoint(open_profile_xy[i,0], open_profile_xy[i,1], open_profile_z[i])
-                    line_geometry.AddPoint(closed_profile_xy[i,0], closed_profile_xy[i,1], closed_profile_z[i])
-                    line_feature.SetGeometry(line_geometry)
-                    output_lines_layer.CreateFeature(line_feature)
-                    line_feature = None
-
-                valid_profile_count += 1
+            if horseshoe_geometry.GetPointCount() == 4:
+                # We want to consider only the X and Y of the geometry
+                horseshoe_xy = np.array(horseshoe_geometry.GetPoints())[:,:2]
+
+                horseshoe_bbox = BoundingBox(
+                    x_min=np.min(horseshoe_xy[:,0]),
+                    x_max=np.max(horseshoe_xy[:,0]),
+                    y_min=np.min(horseshoe_xy[:,1]),
+                    y_max=np.max(horseshoe_xy[:,1]),
+                )
+
+                # Length of (open) AD segment
+                open_profile_length = np.hypot(
+                    horseshoe_xy[3, 0] - horseshoe_xy[0, 0],
+                    horseshoe_xy[3, 1] - horseshoe_xy[0, 1],
+                )
+                # Length of (closed) BC segment
+                closed_profile_length = np.hypot(
+                    horseshoe_xy[2, 0] - horseshoe_xy[1, 0],
+                    horseshoe_xy[2, 1] - horseshoe_xy[1, 1],
+                )
+
+                # Determine number of samples to take along the profiles (at least 2)
+                longest_profile_length = max(open_profile_length, closed_profile_length)
+                num_profile_samples = max(2, int(np.ceil(longest_profile_length / max_profile_sample_dist)) + 1)
+
+                # Along-profile coordinates
+                profile_abscissa = np.linspace(
+                    0.0,
+                    1.0,
+                    num_profile_samples,
+                    endpoint=True,
+                )
+
+                # Interpolate (X, Y) along the two profiles
+                open_profile_xy = horseshoe_xy[0,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[3,:] - horseshoe_xy[0,:])
+                closed_profile_xy = horseshoe_xy[1,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[2,:] - horseshoe_xy[1,:])
+
+                # Reuse Z from a previous run if neither the horseshoe nor the DEM
+                # under it has changed
+                profile_z = None
+                if sampling_cache is not None:
+                    cache_key = sampling_cache.get_key(horseshoe_xy, horseshoe_bbox)
+                    profile_z = sampling_cache.get(cache_key)
+
+                if profile_z is None:
+                    # Get a raster window just covering this horseshoe
+                    window_raster_dataset = get_raster_window(input_raster_dataset, horseshoe_bbox)
+
+                    window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
+
+                    # Sample the raster Z in those interpolated (X, Y) locations
+                    profile_z = np.stack([
+                        window_raster_interpolator((open_profile_xy[:,0], open_profile_xy[:,1])),
+                        window_raster_interpolator((closed_profile_xy[:,0], closed_profile_xy[:,1])),
+                    ])
+
+                    if sampling_cache is not None:
+                        sampling_cache.put(cache_key, profile_z)
+
+                open_profile_z, closed_profile_z = profile_z
+
+                # Render only if there is no NaN in the profiles
+                if np.all(np.isfinite(open_profile_z)) and np.all(np.isfinite(closed_profile_z)):
+                    # Create line features
+                    for i in range(num_profile_samples):
+                        line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
+                        line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+                        line_geometry.AddPoint(open_profile_xy[i,0], open_profile_xy[i,1], open_profile_z[i])
+                        line_geometry.AddPoint(closed_profile_xy[i,0], closed_profile_xy[i,1], closed_profile_z[i])
+                        line_feature.SetGeometry(line_geometry)
+                        output_lines_layer.CreateFeature(line_feature)
+                        line_feature = None
+
+                    valid_profile_count += 1
+                else:
+                    invalid_profile_count += 1
+
+                expected_pointcount_count += 1
             else:
-                invalid_profile_count += 1
+                # Point count not equal to 4, skip this geometry and warn.
+                # (The horseshoe layer may be flawed, which we can tolerate here.)
+                unexpected_pointcount_count += 1
 
-            expected_pointcount_count += 1
-        else:
-            # Point count not equal to 4, skip this geometry and warn.
-            # (The horseshoe layer may be flawed, which we can tolerate here.)
-            unexpected_pointcount_count += 1
+        if sampling_cache is not None:
+            logging.info(f"reused cached Z for {sampling_cache.hit_count} horseshoe objects, sampled {sampling_cache.miss_count}")
 
     logging.info(f"processed {expected_pointcount_count} horseshoe geometries")
     if unexpected_pointcount_count != 0:
@@ -1,9 +1,11 @@
 from hydroadjust.sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from hydroadjust.caching import SamplingCache
 
 from osgeo import gdal, ogr
 import numpy as np
 from tqdm import tqdm
 import argparse
+from contextlib import nullcontext
 import logging
 
 gdal.UseExceptions()
@@ -22,6 +24,7 @@ def main():
     argument_parser.add_argument('input_raster', type=str, help='input DEM raster dataset to sample')
     argument_parser.add_argument('input_lines', type=str, help='input line-object vector data source')
     argument_parser.add_argument('output_lines', type=str, help='output geometry file for lines with Z')
+    argument_parser.add_argument('--cache', type=str, help='SQLite file to cache sampled Z in between runs')
 
     input_arguments = argument_parser.parse_args()
 
@@ -31,6 +34,12 @@ def main():
 
     input_raster_dataset = gdal.Open(input_raster_path)
 
+    # Samples stored so far are committed even if the loop below fails
+    if input_arguments.cache is None:
+        sampling_cache_context = nullcontext()
+    else:
+        sampling_cache_context = SamplingCache(input_arguments.cache, input_raster_dataset)
+
     input_lines_datasrc = ogr.Open(input_lines_path)
     input_lines_layer = input_lines_datasrc.GetLayer()
 
@@ -49,53 +58,68 @@ def main():
     valid_sampling_count = 0
     invalid_sampling_count = 0
 
-    for input_line_feature in tqdm(input_lines_layer, ascii=True, unit="obj"):
-        input_line_geometry = input_line_feature.GetGeometryRef()
-
-        # Rule out unexpected geometry types (apparently calling .GetGeomType() on
-        # the layer yields weird results)
-        if not (input_line_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
-            raise ValueError("encountered unexpected geometry type")
-
-        if input_line_geometry.GetPointCount() == 2:
-            # We want to consider only the X and Y of the geometry
-            input_line_xy = np.array(input_line_geometry.GetPoints())[:,:2]
-
-            input_line_bbox = BoundingBox(
-                x_min=np.min(input_line_xy[:,0]),
-                x_max=np.max(input_line_xy[:,0]),
-                y_min=np.min(input_line_xy[:,1]),
-                y_max=np.max(input_line_xy[:,1]),
-            )
-
-            # Get a raster window just covering this line object
-            window_raster_dataset = get_raster_window(input_raster_dataset, input_line_bbox)
-
-            window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-
-            # Get raster Z for the respective endpoints
-            input_line_z = window_raster_interpolator((input_line_xy[:,0], input_line_xy[:,1]))
-
-            # Render only if no Z value is NaN
-            if np.all(np.isfinite(input_line_z)):
-                # Create output feature
-                output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                output_line_geometry.AddPoint(input_line_xy[0,0], input_line_xy[0,1], input_line_z[0])
-                output_line_geometry.AddPoint(input_line_xy[1,0], input_line_xy[1,1], input_line_z[1])
-                output_line_feature.SetGeometry(output_line_geometry)
-                output_lines_layer.CreateFeature(output_line_feature)
-                output_line_feature = None
-
-                valid_sampling_count += 1
+    with sampling_cache_context as sampling_cache:
+        for input_line_feature in tqdm(input_lines_layer, ascii=True, unit="obj"):
+            input_line_geometry = input_line_feature.GetGeometryRef()
+
+            # Rule out unexpected geometry types (apparently calling .GetGeomType() on
+            # the layer yields weird results)
+            if not (input_line_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
+                raise ValueError("encountered unexpected geometry type")
+
+            if input_line_geometry.GetPointCount() == 2:
+                # We want to consider only the X and Y of the geometry
+                input_line_xy = np.array(input_line_geometry.GetPoints())[:,:2]
+
+                input_line_bbox = BoundingBox(
+                    x_min=np.min(input_line_xy[:,0]),
+                    x_max=np.max(input_line_xy[:,0]),
+                    y_min=np.min(input_line_xy[:,1]),
+                    y_max=np.max(input_line_xy[:,1]),
+                )
+
+                # Reuse Z from a previous run if neither the line nor the DEM
+                # under it has changed
+                input_line_z = None
+                if sampling_cache is not None:
+                    cache_key = sampling_cache.get_key(input_line_xy, input_line_bbox)
+                    input_line_z = sampling_cache.get(cache_key)
+
+                if input_line_z is None:
+                    # Get a raster window just covering this line object
+                    window_raster_dataset = get_raster_window(input_raster_dataset, input_line_bbox)
+
+                    window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
+
+                    # Get raster Z for the respective endpoints
+                    input_line_z = window_raster_interpolator((input_line_xy[:,0], input_line_xy[:,1]))
+
+                    if sampling_cache is not None:
+                        sampling_cache.put(cache_key, input_line_z)
+
+                # Render only if no Z value is NaN
+                if np.all(np.isfinite(input_line_z)):
+                    # Create output feature
+                    output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
+                    output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+                    output_line_geometry.AddPoint(input_line_xy[0,0], input_line_xy[0,1], input_line_z[0])
+                    output_line_geometry.AddPoint(input_line_xy[1,0], input_line_xy[1,1], input_line_z[1])
+                    output_line_feature.SetGeometry(output_line_geometry)
+                    output_lines_layer.CreateFeature(output_line_feature)
+                    output_line_feature = None
+
+                    valid_sampling_count += 1
+                else:
+                    invalid_sampling_count += 1
+
+                expected_pointcount_count += 1
             else:
-                invalid_sampling_count += 1
+                # Point count not equal to 2, skip this geometry and warn.
+                # (The input layer may be flawed, which we can tolerate here.)
+                unexpected_pointcount_count += 1
 
-            expected_pointcount_count += 1
-        else:
-            # Point count not equal to 2, skip this geometry and warn.
-            # (The input layer may be flawed, which we can tolerate here.)
-            unexpected_pointcount_count += 1
+        if sampling_cache is not None:
+            logging.info(f"reused cached Z for {sampling_cache.hit_count} line objects, sampled {sampling_cache.miss_count}")
 
     logging.info(f"processed {expected_pointcount_count} line geometries")
     if unexpected_pointcount_count != 0:
@@ -11,6 +11,7 @@ setup(
             "sample_line_z = hydroadjust.cli.sample_line_z:main",
             "sample_horseshoe_z_lines = hydroadjust.cli.sample_horseshoe_z_lines:main",
             "burn_line_z = hydroadjust.cli.burn_line_z:main",
+            "compact_sampling_cache = hydroadjust.cli.compact_sampling_cache:main",
         ],
     },
 )
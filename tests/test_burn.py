@@ -2,6 +2,7 @@ from hydroadjust.burning import burn_lines
 
 from osgeo import gdal, ogr, osr
 import numpy as np
+import pytest
 
 
 def test_burn_lines():
@@ -66,3 +67,160 @@ def test_burn_lines():
     # Check result
     raster_output_grid = raster_band.ReadAsArray()
     np.testing.assert_allclose(raster_output_grid, raster_expected_grid)
+
+
+@pytest.mark.parametrize("pixel_size", [0.5, 0.4])
+def test_burn_lines_threaded(pixel_size):
+    # Test that burning in row bands on multiple threads gives exactly the
+    # same result as the serial path, including for lines that cross band
+    # boundaries, lines with vertices exactly on row edges and lines that
+    # overlap each other. A pixel size of 0.4 (as in the DHM) is not exactly
+    # representable, which would expose any difference in how pixel
+    # coordinates are computed.
+    
+    raster_num_rows, raster_num_cols = 40, 30
+    raster_input_grid = np.arange(float(raster_num_rows*raster_num_cols)).reshape(raster_num_rows, raster_num_cols)
+    raster_geotransform = [600000.0, pixel_size, 0.0, 6200000.0, 0.0, -pixel_size]
+    raster_projection = "EPSG:25832"
+    
+    lines_srs = osr.SpatialReference()
+    lines_srs.ImportFromEPSG(25832)
+    
+    # Line endpoints given as (column, row, Z), converted to georeferenced
+    # coordinates below
+    line_pixel_coords = [
+        # Steep line crossing all bands
+        ((2.6, 39.6, 10.0), (27.4, 0.2, 20.0)),
+        # Shallow line within few rows, crossing a band boundary
+        ((0.2, 10.2, 30.0), (29.8, 11.8, 40.0)),
+        # Overlapping the first line, burned later
+        ((24.4, 37.2, 50.0), (5.2, 3.4, 60.0)),
+        # Line entirely within one band
+        ((8.8, 4.8, 70.0), (12.2, 5.4, 80.0)),
+        # Vertices exactly on row edges at band boundaries
+        ((3.0, 10.0, 90.0), (17.0, 30.0, 100.0)),
+        ((1.5, 20.0, 110.0), (9.5, 27.0, 120.0)),
+        # Horizontal line exactly on a row edge
+        ((14.0, 20.0, 130.0), (26.0, 20.0, 140.0)),
+    ]
+    
+    def create_raster():
+        raster_driver = gdal.GetDriverByName("MEM")
+        raster_dataset = raster_driver.Create(
+            "temp_raster",
+            raster_num_cols,
+            raster_num_rows,
+            1,
+            gdal.GDT_Float32,
+        )
+        raster_dataset.SetProjection(raster_projection)
+        raster_dataset.SetGeoTransform(raster_geotransform)
+        raster_dataset.GetRasterBand(1).WriteArray(raster_input_grid)
+        return raster_dataset
+    
+    vector_driver = ogr.GetDriverByName("MEMORY")
+    lines_datasrc = vector_driver.CreateDataSource("temp_vector")
+    lines_datasrc.CreateLayer(
+        "lines",
+        srs=lines_srs,
+        geom_type=ogr.wkbLineString25D,
+    )
+    lines_layer = lines_datasrc.GetLayer()
+    for line_endpoints in line_pixel_coords:
+        line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+        for col, row, z in line_endpoints:
+            line_geometry.AddPoint(
+                raster_geotransform[0] + col*raster_geotransform[1],
+                raster_geotransform[3] + row*raster_geotransform[5],
+                z,
+            )
+        line_feature = ogr.Feature(lines_layer.GetLayerDefn())
+        line_feature.SetGeometry(line_geometry)
+        lines_layer.CreateFeature(line_feature)
+        line_feature = None
+    
+    serial_dataset = create_raster()
+    burn_lines(serial_dataset, lines_layer)
+    serial_output_grid = serial_dataset.GetRasterBand(1).ReadAsArray()
+    
+    # Sanity check that the lines were actually burned in
+    assert np.any(serial_output_grid != raster_input_grid)
+    
+    for num_threads, rows_per_band in [(2, None), (4, 3), (3, 1), (2, 10)]:
+        threaded_dataset = create_raster()
+        burn_lines(threaded_dataset, lines_layer, num_threads=num_threads, rows_per_band=rows_per_band)
+        threaded_output_grid = threaded_dataset.GetRasterBand(1).ReadAsArray()
+        np.testing.assert_array_equal(threaded_output_grid, serial_output_grid)
+
+
+def test_burn_lines_threaded_arguments():
+    # Test that invalid thread and band settings are rejected up front
+    raster_dataset = gdal.GetDriverByName("MEM").Create("temp_raster", 5, 4, 1, gdal.GDT_Float32)
+    raster_dataset.SetGeoTransform([600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0])
+    lines_datasrc = ogr.GetDriverByName("MEMORY").CreateDataSource("temp_vector")
+    lines_layer = lines_datasrc.CreateLayer("lines", geom_type=ogr.wkbLineString25D)
+    
+    with pytest.raises(ValueError):
+        burn_lines(raster_dataset, lines_layer, num_threads=0)
+    with pytest.raises(ValueError):
+        burn_lines(raster_dataset, lines_layer, num_threads=2, rows_per_band=0)
+
+
+def test_burn_lines_threaded_reprojection():
+    # Test that lines in a different SRS than the raster are reprojected in
+    # the threaded path, just as RasterizeLayer does in the serial path.
+    
+    raster_num_rows, raster_num_cols = 20, 20
+    raster_input_grid = np.zeros((raster_num_rows, raster_num_cols))
+    raster_geotransform = [600000.0, 0.4, 0.0, 6200000.0, 0.0, -0.4]
+    raster_projection = "EPSG:25832"
+    
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromEPSG(25832)
+    raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    lines_srs = osr.SpatialReference()
+    lines_srs.ImportFromEPSG(25833)
+    lines_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_lines_srs = osr.CoordinateTransformation(raster_srs, lines_srs)
+    
+    def create_raster():
+        raster_driver = gdal.GetDriverByName("MEM")
+        raster_dataset = raster_driver.Create(
+            "temp_raster",
+            raster_num_cols,
+            raster_num_rows,
+            1,
+            gdal.GDT_Float32,
+        )
+        raster_dataset.SetProjection(raster_projection)
+        raster_dataset.SetGeoTransform(raster_geotransform)
+        raster_dataset.GetRasterBand(1).WriteArray(raster_input_grid)
+        return raster_dataset
+    
+    vector_driver = ogr.GetDriverByName("MEMORY")
+    lines_datasrc = vector_driver.CreateDataSource("temp_vector")
+    lines_layer = lines_datasrc.CreateLayer(
+        "lines",
+        srs=lines_srs,
+        geom_type=ogr.wkbLineString25D,
+    )
+    line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+    line_geometry.AddPoint(600000.5, 6199992.3, 42.0)
+    line_geometry.AddPoint(600007.1, 6199999.2, 42.0)
+    line_geometry.Transform(to_lines_srs)
+    line_feature = ogr.Feature(lines_layer.GetLayerDefn())
+    line_feature.SetGeometry(line_geometry)
+    lines_layer.CreateFeature(line_feature)
+    line_feature = None
+    
+    serial_dataset = create_raster()
+    burn_lines(serial_dataset, lines_layer)
+    serial_output_grid = serial_dataset.GetRasterBand(1).ReadAsArray()
+    
+    # Sanity check that the line landed inside the raster
+    assert np.any(serial_output_grid == 42.0)
+    
+    threaded_dataset = create_raster()
+    burn_lines(threaded_dataset, lines_layer, num_threads=3, rows_per_band=4)
+    threaded_output_grid = threaded_dataset.GetRasterBand(1).ReadAsArray()
+    np.testing.assert_array_equal(threaded_output_grid, serial_output_grid)
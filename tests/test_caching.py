@@ -0,0 +1,333 @@
+import hydroadjust.caching
+from hydroadjust.caching import SamplingCache, compact_cache
+from hydroadjust.sampling import BoundingBox
+import hydroadjust.cli.sample_horseshoe_z_lines
+import hydroadjust.cli.sample_line_z
+
+from osgeo import gdal, ogr, osr
+import numpy as np
+import os
+import pytest
+import sqlite3
+import sys
+
+
+def create_tile(path, grid, x_offset=600000.0, y_offset=6200000.0):
+    # Write a small GeoTIFF tile to act as DEM source. If the tile already
+    # exists, its modification time is moved forward, so that rewrites are
+    # detected even on filesystems with coarse timestamps.
+    old_stat = os.stat(path) if os.path.exists(path) else None
+
+    num_rows, num_cols = grid.shape
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(path, num_cols, num_rows, 1, gdal.GDT_Float32)
+    dataset.SetProjection("EPSG:25832")
+    dataset.SetGeoTransform([x_offset, 1.0, 0.0, y_offset, 0.0, -1.0])
+    dataset.GetRasterBand(1).WriteArray(grid)
+    dataset = None
+
+    if old_stat is not None:
+        new_mtime_ns = old_stat.st_mtime_ns + 1000000000
+        os.utime(path, ns=(new_mtime_ns, new_mtime_ns))
+
+
+def get_bbox(xy):
+    return BoundingBox(
+        x_min=np.min(xy[:,0]),
+        x_max=np.max(xy[:,0]),
+        y_min=np.min(xy[:,1]),
+        y_max=np.max(xy[:,1]),
+    )
+
+
+def test_sampling_cache(tmp_path):
+    # Tests that sampled Z values survive between cache sessions, and that
+    # the key changes whenever the geometry, the DEM contents or the
+    # sampling distance change.
+
+    tile_path = str(tmp_path / "tile.tif")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+
+    line_xy = np.array([[600000.5, 6199996.5], [600003.5, 6199998.5]])
+    line_bbox = get_bbox(line_xy)
+    line_z = np.array([15.0, np.nan])
+
+    # First session: nothing cached yet
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        key = cache.get_key(line_xy, line_bbox)
+        assert cache.get(key) is None
+        cache.put(key, line_z)
+    raster_dataset = None
+
+    # Second session: same geometry and DEM, Z is reused
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) == key
+        np.testing.assert_array_equal(cache.get(key), line_z)
+        assert cache.hit_count == 1
+
+        # A moved line must not hit the cache
+        moved_xy = line_xy.copy()
+        moved_xy[1, 1] = 6199998.25
+        assert cache.get_key(moved_xy, get_bbox(moved_xy)) != key
+
+    # A different sampling distance must not hit the cache
+    with SamplingCache(cache_path, raster_dataset, max_profile_sample_dist=0.5) as cache:
+        assert cache.get_key(line_xy, line_bbox) != key
+    raster_dataset = None
+
+    # Changed DEM contents must not hit the cache
+    create_tile(tile_path, np.ones((4, 5)))
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) != key
+    raster_dataset = None
+
+
+def test_sampling_cache_sidecar(tmp_path):
+    # Tests that a sidecar file next to a plain GeoTIFF DEM does not cause
+    # the DEM itself to be left out of the key.
+
+    tile_path = str(tmp_path / "tile.tif")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+    with open(tile_path + ".aux.xml", "w") as aux_file:
+        aux_file.write("<PAMDataset></PAMDataset>")
+
+    line_xy = np.array([[600000.5, 6199996.5], [600003.5, 6199998.5]])
+    line_bbox = get_bbox(line_xy)
+
+    raster_dataset = gdal.Open(tile_path)
+    assert len(raster_dataset.GetFileList()) > 1
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        key = cache.get_key(line_xy, line_bbox)
+    raster_dataset = None
+
+    create_tile(tile_path, np.ones((4, 5)))
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) != key
+    raster_dataset = None
+
+
+def test_sampling_cache_vrt_tiles(tmp_path):
+    # Tests that with a tiled VRT, only the tiles touched by an object
+    # contribute to its key.
+
+    west_tile_path = str(tmp_path / "west.tif")
+    east_tile_path = str(tmp_path / "east.tif")
+    vrt_path = str(tmp_path / "dem.vrt")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(west_tile_path, np.arange(100.0).reshape(10, 10), x_offset=600000.0)
+    create_tile(east_tile_path, np.arange(100.0).reshape(10, 10), x_offset=600010.0)
+    gdal.BuildVRT(vrt_path, [west_tile_path, east_tile_path]).FlushCache()
+
+    line_xy = np.array([[600001.5, 6199996.5], [600004.5, 6199998.5]])
+    line_bbox = get_bbox(line_xy)
+
+    raster_dataset = gdal.Open(vrt_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert len(cache.tiles) == 2
+        key = cache.get_key(line_xy, line_bbox)
+    raster_dataset = None
+
+    # Untouched tile changed: key unchanged
+    create_tile(east_tile_path, np.ones((10, 10)), x_offset=600010.0)
+    raster_dataset = gdal.Open(vrt_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) == key
+    raster_dataset = None
+
+    # Touched tile changed: key changed
+    create_tile(west_tile_path, np.ones((10, 10)), x_offset=600000.0)
+    raster_dataset = gdal.Open(vrt_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) != key
+    raster_dataset = None
+
+
+def test_sampling_cache_vrt_nodata(tmp_path):
+    # Tests that changing the NODATA value of a VRT changes the key, even
+    # though the tiles themselves are unchanged.
+
+    tile_path = str(tmp_path / "tile.tif")
+    vrt_path = str(tmp_path / "dem.vrt")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+
+    line_xy = np.array([[600000.5, 6199996.5], [600003.5, 6199998.5]])
+    line_bbox = get_bbox(line_xy)
+
+    keys = []
+    for vrt_nodata in [-9999.0, 7.0]:
+        gdal.BuildVRT(vrt_path, [tile_path], VRTNodata=vrt_nodata).FlushCache()
+        raster_dataset = gdal.Open(vrt_path)
+        with SamplingCache(cache_path, raster_dataset) as cache:
+            keys.append(cache.get_key(line_xy, line_bbox))
+        raster_dataset = None
+
+    assert keys[0] != keys[1]
+
+
+def test_sampling_cache_sidecar_identified_once(tmp_path, monkeypatch):
+    # Tests that unchanged files are not opened or identified again on later
+    # runs, including sidecars that are not rasters.
+
+    tile_path = str(tmp_path / "tile.tif")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+    with open(tile_path + ".aux.xml", "w") as aux_file:
+        aux_file.write("<PAMDataset></PAMDataset>")
+
+    line_xy = np.array([[600000.5, 6199996.5], [600003.5, 6199998.5]])
+    line_bbox = get_bbox(line_xy)
+
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        key = cache.get_key(line_xy, line_bbox)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("unchanged file was opened again")
+
+    monkeypatch.setattr(gdal, "IdentifyDriver", fail)
+    monkeypatch.setattr(gdal, "Open", fail)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        assert cache.get_key(line_xy, line_bbox) == key
+    raster_dataset = None
+
+
+def test_sampling_cache_periodic_commit(tmp_path, monkeypatch):
+    # Tests that stored samples become visible to other connections before
+    # the cache is closed, so that it can be shared between processes.
+
+    tile_path = str(tmp_path / "tile.tif")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+    monkeypatch.setattr(hydroadjust.caching, "COMMIT_INTERVAL", 2)
+
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        cache.put("first", np.array([1.0, 2.0]))
+        cache.put("second", np.array([3.0, 4.0]))
+
+        connection = sqlite3.connect(cache_path)
+        stored_count, = connection.execute("SELECT COUNT(*) FROM samples").fetchone()
+        connection.close()
+        assert stored_count == 2
+    raster_dataset = None
+
+
+def test_sampling_cache_without_files(tmp_path):
+    # Tests that caching is refused for a DEM without any source files, as
+    # changes to it could not be detected.
+
+    raster_dataset = gdal.GetDriverByName("MEM").Create("temp_raster", 5, 4, 1, gdal.GDT_Float32)
+    raster_dataset.SetGeoTransform([600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0])
+
+    with pytest.raises(ValueError):
+        SamplingCache(str(tmp_path / "cache.sqlite"), raster_dataset)
+
+
+def test_compact_cache(tmp_path):
+    # Tests that compaction evicts only samples that have not been used
+    # recently.
+
+    tile_path = str(tmp_path / "tile.tif")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(20.0).reshape(4, 5))
+
+    raster_dataset = gdal.Open(tile_path)
+    with SamplingCache(cache_path, raster_dataset) as cache:
+        cache.put("old", np.array([1.0, 2.0]))
+        cache.put("new", np.array([3.0, 4.0]))
+    raster_dataset = None
+
+    connection = sqlite3.connect(cache_path)
+    connection.execute("UPDATE samples SET last_used = 0 WHERE key = 'old'")
+    connection.commit()
+    connection.close()
+
+    evicted_sample_count, evicted_tile_count = compact_cache(cache_path, max_age_days=1.0)
+    assert evicted_sample_count == 1
+    assert evicted_tile_count == 0
+
+    connection = sqlite3.connect(cache_path)
+    remaining_keys = [key for (key,) in connection.execute("SELECT key FROM samples")]
+    connection.close()
+    assert remaining_keys == ["new"]
+
+    # A mistyped path must not result in a new, empty cache
+    missing_cache_path = str(tmp_path / "missing.sqlite")
+    with pytest.raises(FileNotFoundError):
+        compact_cache(missing_cache_path, max_age_days=1.0)
+    assert not os.path.exists(missing_cache_path)
+
+
+def write_linestrings(path, coords):
+    # Write 2D linestring objects to a gpkg datasource
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(25832)
+    datasrc = ogr.GetDriverByName("gpkg").CreateDataSource(path)
+    layer = datasrc.CreateLayer("objects", srs=srs, geom_type=ogr.wkbLineString)
+    for object_coords in coords:
+        geometry = ogr.Geometry(ogr.wkbLineString)
+        for x, y in object_coords:
+            geometry.AddPoint_2D(x, y)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+        feature = None
+    datasrc = None
+
+
+def read_linestrings(path):
+    datasrc = ogr.Open(path)
+    return [feature.GetGeometryRef().GetPoints() for feature in datasrc.GetLayer()]
+
+
+@pytest.mark.parametrize(
+    "cli_module, object_coords, extra_args",
+    [
+        (
+            hydroadjust.cli.sample_line_z,
+            [[(600001.5, 6199991.5), (600008.5, 6199997.5)]],
+            [],
+        ),
+        (
+            hydroadjust.cli.sample_horseshoe_z_lines,
+            [[(600002.0, 6199992.0), (600002.0, 6199998.0), (600008.0, 6199998.0), (600008.0, 6199992.0)]],
+            ["--max-sample-dist", "1.0"],
+        ),
+    ],
+)
+def test_cli_cache(tmp_path, monkeypatch, cli_module, object_coords, extra_args):
+    # Tests that a second run with the cache gives identical output without
+    # reading the raster.
+
+    tile_path = str(tmp_path / "tile.tif")
+    objects_path = str(tmp_path / "objects.gpkg")
+    cache_path = str(tmp_path / "cache.sqlite")
+    create_tile(tile_path, np.arange(100.0).reshape(10, 10))
+    write_linestrings(objects_path, object_coords)
+
+    def run(output_path):
+        monkeypatch.setattr(
+            sys,
+            "argv",
+            ["prog", tile_path, objects_path, output_path, "--cache", cache_path] + extra_args,
+        )
+        cli_module.main()
+        return read_linestrings(output_path)
+
+    first_output = run(str(tmp_path / "first.gpkg"))
+    assert len(first_output) > 0
+
+    def fail_get_raster_window(*args, **kwargs):
+        raise AssertionError("raster was read despite cached samples")
+
+    monkeypatch.setattr(cli_module, "get_raster_window", fail_get_raster_window)
+    second_output = run(str(tmp_path / "second.gpkg"))
+
+    assert second_output == first_output